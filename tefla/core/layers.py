@@ -289,6 +289,7 @@ def dilated_conv2d(x,
                    batch_norm_args=None,
                    activation=None,
                    use_bias=True,
+                   data_format='NHWC',
                    outputs_collections=None):
   """Adds a 2D dilated convolutional layer.
 
@@ -336,6 +337,12 @@ def dilated_conv2d(x,
           `GraphKeys.TRAINABLE_VARIABLES` (see tf.Variable).
       name: Optional name or scope for variable_scope/name_scope.
       use_bias: Whether to add bias or not
+      data_format: one of `"NHWC"` or `"NCHW"`, the layout of `x` and of the output.
+          `"NCHW"` is only supported on GPU, where it avoids the layout transposes
+          around cuDNN.
+
+  Variables are always created as float32; if `x` has another float dtype (e.g.
+  float16 for mixed precision) they are cast to it and the conv runs in that dtype.
 
   Returns:
       The 4-D `Tensor` variable representing the result of the series of operations.
@@ -347,15 +354,38 @@ def dilated_conv2d(x,
   input_shape = helper.get_input_shape(x)
   assert len(input_shape) == 4, "Input Tensor shape must be 4-D"
   with tf.variable_scope(name, reuse=reuse):
-    shape = helper.filter_2d(filter_size,
-                             x.get_shape()[-1], n_output_channels) if hasattr(w_init,
-                                                                              '__call__') else None
+    in_channels = x.get_shape()[-1] if data_format == 'NHWC' else x.get_shape()[1]
+    shape = helper.filter_2d(filter_size, in_channels,
+                             n_output_channels) if hasattr(w_init, '__call__') else None
     W = tf.get_variable(
         name='W', shape=shape, initializer=w_init, regularizer=w_regularizer, trainable=trainable)
-
-    output = tf.nn.atrous_conv2d(
-        value=x, filters=W, rate=dilation, padding=helper.kernel_padding(padding))
-
+    if W.dtype.base_dtype != x.dtype.base_dtype:
+      # float32 weights used by a lower precision (e.g. float16) conv
+      W = tf.cast(W, x.dtype)
+
+    if data_format == 'NCHW' and 1 < dilation <= 3:
+      # NCHW convs only run on GPU, where cuDNN has native dilated kernels for
+      # small rates; this skips the SpaceToBatchND/BatchToSpaceND round trip.
+      output = tf.nn.conv2d(
+          x,
+          W,
+          strides=[1, 1, 1, 1],
+          padding=helper.kernel_padding(padding),
+          data_format=data_format,
+          dilations=[1, 1, dilation, dilation])
+    else:
+      # For rate > 1 the convolution deinterlaces the input (SpaceToBatchND), runs
+      # a dense conv with the undilated filter and reinterlaces (BatchToSpaceND);
+      # the filter is never upsampled with zeros.
+      output = tf.nn.convolution(
+          input=x,
+          filter=W,
+          padding=helper.kernel_padding(padding),
+          dilation_rate=[dilation, dilation],
+          data_format=data_format)
+
+    # The bias is added on the reinterlaced output, which is smaller than the
+    # padded space-to-batch tensor the conv itself runs on.
     if use_bias:
       if untie_biases:
         b = tf.get_variable(
@@ -364,6 +394,8 @@ def dilated_conv2d(x,
             initializer=tf.constant_initializer(b_init),
             trainable=trainable,
         )
+        if b.dtype.base_dtype != output.dtype.base_dtype:
+          b = tf.cast(b, output.dtype)
         output = tf.add(output, b)
       else:
         b = tf.get_variable(
@@ -372,7 +404,9 @@ def dilated_conv2d(x,
             initializer=tf.constant_initializer(b_init),
             trainable=trainable,
         )
-        output = tf.nn.bias_add(value=output, bias=b)
+        if b.dtype.base_dtype != output.dtype.base_dtype:
+          b = tf.cast(b, output.dtype)
+        output = tf.nn.bias_add(value=output, bias=b, data_format=data_format)
 
     if batch_norm is not None:
       if isinstance(batch_norm, bool):
@@ -2142,8 +2176,12 @@ def layer_norm(x,
         "layer_norm_scale", [filters], initializer=tf.ones_initializer(), trainable=trainable)
     bias = tf.get_variable(
         "layer_norm_bias", [filters], initializer=tf.zeros_initializer(), trainable=trainable)
+    if scale.dtype.base_dtype != x.dtype.base_dtype:
+      # float32 parameters used with e.g. float64 inputs
+      scale = tf.cast(scale, x.dtype)
+      bias = tf.cast(bias, x.dtype)
     if allow_defun:
-      output = layer_norm_compute(x, tf.constant(epsilon), scale, bias)
+      output = layer_norm_compute(x, tf.constant(epsilon, dtype=x.dtype), scale, bias)
       output.set_shape(x.get_shape())
     else:
       output = _layer_norm_compute_python(x, epsilon, scale, bias)
@@ -1,19 +1,22 @@
 import re
 import functools
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 import contextlib
-import random
+import hashlib
 import tensorflow as tf
 from tensorflow.python.framework import function
+from tensorflow.python.util import nest
+from tensorflow.contrib.compiler import jit
 from .layers import dilated_conv2d, conv1d, layer_norm, _layer_norm_compute_python, \
     _collect_named_outputs
 from .optimizer import VariableClippingOptimizer
 from . import initializers as initz
 
 _function_cache = {}
+_ConvConfig = namedtuple('_ConvConfig', ['filter_size', 'dilation', 'data_format'])
 
 
-def fn_with_custom_grad(grad_fn, use_global_vars=False):
+def fn_with_custom_grad(grad_fn, use_global_vars=False, scope=None):
   """Decorator to create a subgraph with a custom gradient function.
 
   The subgraph created by the decorated function is NOT put in a Defun and so
@@ -26,6 +29,9 @@ def fn_with_custom_grad(grad_fn, use_global_vars=False):
          all of which are lists of Tensors.
       use_global_vars: if True, variables will be the global variables created.
           If False, will be the trainable variables.
+      scope: optional `VariableScope` or name reused by every call. Pass it (with
+          `reuse` set as needed) to skip opening a new uniquely named scope on
+          each call. If None, a new `fn_with_custom_grad` scope is created per call.
 
   Returns:
       Decorator for function such that the gradient is defined by grad_fn.
@@ -34,14 +40,14 @@ def fn_with_custom_grad(grad_fn, use_global_vars=False):
   def dec(fn):
 
     def wrapped(*args):
-      return _fn_with_custom_grad(fn, args, grad_fn, use_global_vars=use_global_vars)
+      return _fn_with_custom_grad(fn, args, grad_fn, use_global_vars=use_global_vars, scope=scope)
 
     return wrapped
 
   return dec
 
 
-def _fn_with_custom_grad(fn, inputs, grad_fn, use_global_vars=False):
+def _fn_with_custom_grad(fn, inputs, grad_fn, use_global_vars=False, scope=None):
   """Create a subgraph with a custom gradient.
 
   Args:
@@ -52,89 +58,155 @@ def _fn_with_custom_grad(fn, inputs, grad_fn, use_global_vars=False):
           all of which are lists of Tensors.
       use_global_vars: if True, variables will be the global variables created.
          If False, will be the trainable variables.
+      scope: optional `VariableScope` or name for the variables of fn. If None, a
+         new uniquely named scope is created.
 
   Returns:
       fn(*inputs)
   """
-  with tf.variable_scope(None, default_name="fn_with_custom_grad") as vs:
+  with tf.variable_scope(scope, default_name="fn_with_custom_grad") as vs:
     inputs = list(inputs)
     outputs = fn(*inputs)
     if use_global_vars:
-      train_vars = list(vs.global_variables())
+      train_vars = vs.global_variables()
     else:
-      train_vars = list(vs.trainable_variables())
+      train_vars = vs.trainable_variables()
 
   if grad_fn is None:
     return outputs
   else:
-    if not (isinstance(outputs, tuple) or isinstance(outputs, list)):
-      outputs = [outputs]
-    outputs = list(outputs)
-
-    in_types = [t.dtype for t in inputs]
-    out_types = [t.dtype for t in outputs]
-    var_types = [t.dtype for t in train_vars]
-
-    def custom_grad_fn(op, *dys):
-      """Custom grad fn applying grad_fn for identity Defun."""
-      dys = list(dys)
-      fn_inputs = op.inputs[:len(inputs)]
-      fn_vars = op.inputs[len(inputs):len(inputs) + len(train_vars)]
-      fn_outputs = op.inputs[len(inputs) + len(train_vars):]
-      assert len(fn_outputs) == len(outputs)
-      assert len(fn_outputs) == len(dys)
-
-      grad_inputs, grad_vars = grad_fn(fn_inputs, fn_vars, fn_outputs, dys)
-      grad_outputs = [None] * len(fn_outputs)
-      return tuple(grad_inputs + grad_vars + grad_outputs)
-
-    # The Defun takes as input the original inputs, the trainable variables
-    # created in fn, and the outputs. In the forward it passes through the
-    # outputs. In the backwards, it produces gradients for the original inputs
-    # and the trainable variables.
-    @function.Defun(
-        *(in_types + var_types + out_types),
-        func_name="identity_custom_grad%d" % random.randint(1, 10**9),
-        python_grad_func=custom_grad_fn,
-        shape_func=lambda _: [t.get_shape() for t in outputs])
-    def identity(*args):
-      outs = args[len(inputs) + len(train_vars):]
-      return tuple([tf.identity(t) for t in outs])
-
-    id_out = identity(*(inputs + train_vars + outputs))
+    outputs = nest.flatten(outputs)
+
+    all_tensors = (*inputs, *train_vars, *outputs)
+    all_types = tuple(t.dtype for t in all_tensors)
+    vars_start = len(inputs)
+    outputs_start = vars_start + len(train_vars)
+
+    identity = _identity_custom_grad(all_types[:vars_start], all_types[vars_start:outputs_start],
+                                     all_types[outputs_start:])
+    id_out = identity(*all_tensors)
+    id_op = id_out.op if isinstance(id_out, tf.Tensor) else id_out[0].op
+    # Stored on the op so that grad_fn, and the graph tensors it references,
+    # live exactly as long as the graph.
+    id_op._custom_grad_fn = grad_fn
     return id_out
 
 
+@functools.lru_cache(maxsize=None)
+def _identity_custom_grad(in_types, var_types, out_types):
+  """Returns the identity Defun used by `_fn_with_custom_grad`.
+
+  The Defun takes as input the original inputs, the trainable variables
+  created in fn, and the outputs. In the forward it passes through the
+  outputs. In the backwards, it produces gradients for the original inputs
+  and the trainable variables, using the `grad_fn` stored on the calling
+  op as `op._custom_grad_fn`. The Defun is cached per dtype signature and
+  shared by all the calls with that signature.
+
+  Args:
+      in_types: tuple of input dtypes.
+      var_types: tuple of variable dtypes.
+      out_types: tuple of output dtypes.
+
+  Returns:
+      A `Defun` mapping (inputs, variables, outputs) -> outputs.
+  """
+  # Name derived from the dtype signature, so that functions with different
+  # signatures never share a name, even across processes (e.g. when a graph is
+  # imported with `import_meta_graph`).
+  signature = "|".join(",".join(t.name for t in types) for types in (in_types, var_types, out_types))
+  func_name = "identity_custom_grad_%s" % hashlib.md5(signature.encode()).hexdigest()[:16]
+  # Boundaries of the variables and outputs in the Defun arguments.
+  vars_start = len(in_types)
+  outputs_start = vars_start + len(var_types)
+
+  def custom_grad_fn(op, *dys):
+    """Custom grad fn applying grad_fn for identity Defun."""
+    grad_fn = op._custom_grad_fn
+    dys = list(dys)
+    op_inputs = op.inputs[:]
+    fn_inputs = op_inputs[:vars_start]
+    fn_vars = op_inputs[vars_start:outputs_start]
+    fn_outputs = op_inputs[outputs_start:]
+    assert len(fn_outputs) == len(dys)
+
+    grad_inputs, grad_vars = grad_fn(fn_inputs, fn_vars, fn_outputs, dys)
+    grad_outputs = [None] * len(fn_outputs)
+    return tuple(grad_inputs + grad_vars + grad_outputs)
+
+  @function.Defun(
+      *(in_types + var_types + out_types),
+      func_name=func_name,
+      python_grad_func=custom_grad_fn,
+      shape_func=lambda op: [t.get_shape() for t in op.inputs[outputs_start:]])
+  def identity(*args):
+    # A single IdentityN node forwards all the outputs without copying them.
+    return tuple(tf.identity_n(list(args[outputs_start:])))
+
+  return identity
+
+
 def format_input_left_padding(inputs, **kwargs):
   static_shape = inputs.get_shape()
   if not static_shape or len(static_shape) != 4:
     raise ValueError("Inputs to conv must have statically known rank 4. Shape: " + str(static_shape))
-  dilation = (1, 1)
   assert kwargs['filter_size'] is not None
-  filter_size = kwargs['filter_size']
-  if isinstance(filter_size, int):
-    filter_size = [filter_size, filter_size]
-  if "dilation" in kwargs:
-    dilation_rate = kwargs["dilation"]
-  assert filter_size[0] % 2 == 1 and filter_size[1] % 2 == 1
-  height_padding = 2 * (filter_size[0] // 2) * dilation[0]
-  cond_padding = tf.cond(
-      tf.equal(tf.shape(inputs)[2], 1), lambda: tf.constant(0),
-      lambda: tf.constant(2 * (filter_size[1] // 2) * dilation[1]))
-  width_padding = 0 if static_shape[2] == 1 else cond_padding
-  padding = [[0, 0], [height_padding, 0], [width_padding, 0], [0, 0]]
+  config = _conv_config(kwargs['filter_size'], kwargs.get("dilation", 1),
+                        kwargs.get("data_format", "NHWC"))
+  assert config.filter_size[0] % 2 == 1 and config.filter_size[1] % 2 == 1
+  nchw = config.data_format == "NCHW"
+  width_axis = 3 if nchw else 2
+  if static_shape[width_axis].value is not None:
+    # Width known at graph construction time: a single constant, no control flow.
+    padding = tf.constant(
+        _left_paddings(config, static_shape[width_axis].value == 1), dtype=tf.int32)
+  else:
+    padding = tf.cond(
+        tf.equal(tf.shape(inputs)[width_axis], 1),
+        lambda: tf.constant(_left_paddings(config, True), dtype=tf.int32),
+        lambda: tf.constant(_left_paddings(config, False), dtype=tf.int32))
   inputs = tf.pad(inputs, padding)
-  # Set middle two dimensions to None to prevent convolution from complaining
-  inputs.set_shape([static_shape[0], None, None, static_shape[3]])
+  # Set spatial dimensions to None to prevent convolution from complaining
+  if nchw:
+    inputs.set_shape([static_shape[0], static_shape[1], None, None])
+  else:
+    inputs.set_shape([static_shape[0], None, None, static_shape[3]])
   kwargs["padding"] = "VALID"
   return inputs, kwargs
 
 
+def _conv_config(filter_size, dilation=1, data_format="NHWC"):
+  """Normalizes conv arguments into a hashable `_ConvConfig`.
+
+  Ints are expanded to (height, width) tuples, so equivalent calls map to the
+  same config and share the memoized results keyed on it.
+  """
+  if isinstance(filter_size, int):
+    filter_size = (filter_size, filter_size)
+  if isinstance(dilation, int):
+    dilation = (dilation, dilation)
+  return _ConvConfig(tuple(filter_size), tuple(dilation), data_format)
+
+
+@functools.lru_cache(maxsize=None)
+def _left_paddings(config, unit_width):
+  """Paddings used by `format_input_left_padding`, memoized per conv config."""
+  filter_size, dilation_rate = config.filter_size, config.dilation
+  height_padding = 2 * (filter_size[0] // 2) * dilation_rate[0]
+  width_padding = 0 if unit_width else 2 * (filter_size[1] // 2) * dilation_rate[1]
+  if config.data_format == "NCHW":
+    return ((0, 0), (0, 0), (height_padding, 0), (width_padding, 0))
+  return ((0, 0), (height_padding, 0), (width_padding, 0), (0, 0))
+
+
 def saturating_sigmoid(x):
-  """Saturating sigmoid: 1.2 * sigmoid(x) - 0.1 cut to [0, 1]."""
-  with tf.name_scope("saturating_sigmoid", [x]):
-    y = tf.sigmoid(x)
-    return tf.minimum(1.0, tf.maximum(0.0, 1.2 * y - 0.1))
+  """Saturating sigmoid: 1.2 * sigmoid(x) - 0.1 cut to [0, 1].
+
+  The ops are placed in an XLA jit scope so that sigmoid, affine and clip are
+  fused into a single elementwise kernel.
+  """
+  with tf.name_scope("saturating_sigmoid", [x]), jit.experimental_jit_scope():
+    return tf.clip_by_value(1.2 * tf.sigmoid(x) - 0.1, 0.0, 1.0)
 
 
 def hard_sigmoid(x, saturation_limit=0.9):
@@ -278,6 +350,11 @@ def conv2d_v2(inputs, n_output_channels, is_training, reuse, **kwargs):
           `GraphKeys.TRAINABLE_VARIABLES` (see tf.Variable).
       name: Optional name or scope for variable_scope/name_scope.
       use_bias: Whether to add bias or not
+      data_format: one of `"NHWC"` (default) or `"NCHW"`. `"NCHW"` is only supported
+          on GPU, where cuDNN runs it without layout transposes.
+      compute_dtype: optional float dtype, e.g. `tf.float16`, to run the conv in.
+          The inputs are cast to it, the float32 variables are cast on read and the
+          output is returned in `compute_dtype`.
 
   Returns:
       The 4-D `Tensor` variable representing the result of the series of operations.
@@ -286,6 +363,9 @@ def conv2d_v2(inputs, n_output_channels, is_training, reuse, **kwargs):
   Raises:
       ValueError: if x has rank less than 4 or if its last dimension is not set.
   """
+  compute_dtype = kwargs.pop('compute_dtype', None)
+  if compute_dtype is not None:
+    inputs = tf.cast(inputs, compute_dtype)
   if 'padding' in kwargs and kwargs['padding'] == 'LEFT':
     inputs, kwargs = format_input_left_padding(inputs, **kwargs)
   return dilated_conv2d(inputs, n_output_channels, is_training, reuse, **kwargs)
@@ -298,6 +378,8 @@ def conv2d_gru(inputs,
                filter_size=3,
                padding="SAME",
                dilation=1,
+               data_format='NHWC',
+               compute_dtype=None,
                name='conv2d_gru',
                outputs_collections=None,
                **kwargs):
@@ -334,6 +416,10 @@ def conv2d_gru(inputs,
           `GraphKeys.TRAINABLE_VARIABLES` (see tf.Variable).
       name: Optional name or scope for variable_scope/name_scope.
       use_bias: Whether to add bias or not
+      data_format: one of `"NHWC"` (default) or `"NCHW"`. `"NCHW"` is only supported
+          on GPU, where cuDNN runs it without layout transposes.
+      compute_dtype: optional float dtype, e.g. `tf.float16`, to run the convs and
+          the gate activations in. The output is cast back to the dtype of `inputs`.
 
   Returns:
       The 4-D `Tensor` variable representing the result of the series of operations.
@@ -343,27 +429,58 @@ def conv2d_gru(inputs,
       ValueError: if x has rank less than 4 or if its last dimension is not set.
   """
 
-  def conv2d_fn(x, name, bias_start, padding):
+  def conv2d_fn(x, n_channels, name, bias_start, padding):
     return conv2d_v2(
         x,
-        n_output_channels,
+        n_channels,
         is_training,
         reuse,
         filter_size=filter_size,
         padding=padding,
         b_init=bias_start,
         dilation=dilation,
+        data_format=data_format,
         name=name,
         **kwargs)
 
   with tf.variable_scope(name, reuse=reuse):
-    reset = saturating_sigmoid(conv2d_fn(inputs, "reset", 1.0, padding))
-    gate = saturating_sigmoid(conv2d_fn(inputs, "gate", 1.0, padding))
-    candidate = tf.tanh(conv2d_fn(reset * inputs, "candidate", 0.0, padding))
-    outputs = gate * inputs + (1 - gate) * candidate
+    dtype = inputs.dtype
+    if compute_dtype is not None:
+      inputs = tf.cast(inputs, compute_dtype)
+    # reset and gate read the same inputs, so they are computed by one conv
+    # with twice the output channels.
+    channel_axis = 1 if data_format == 'NCHW' else 3
+    reset_gate = conv2d_fn(inputs, 2 * n_output_channels, "reset_gate", 1.0, padding)
+    reset_pre, gate_pre = tf.split(reset_gate, 2, axis=channel_axis)
+    reset_inputs = _gru_reset_inputs(reset_pre, inputs)
+    candidate_pre = conv2d_fn(reset_inputs, n_output_channels, "candidate", 0.0, padding)
+    outputs = tf.cast(_gru_combine(gate_pre, candidate_pre, inputs), dtype)
     return _collect_named_outputs(outputs_collections, name, outputs)
 
 
+def _gru_reset_inputs(reset_pre, inputs):
+  """Inputs gated by the GRU reset gate, the input of the candidate conv.
+
+  The reset activation and the product are placed in one XLA jit scope, so the
+  reset gate itself is never written to memory.
+  """
+  with tf.name_scope("gru_reset_inputs", [reset_pre, inputs]), jit.experimental_jit_scope():
+    return saturating_sigmoid(reset_pre) * inputs
+
+
+def _gru_combine(gate_pre, candidate_pre, inputs):
+  """GRU state update from the gate and candidate pre-activations.
+
+  The gate activation, candidate activation and the gated sum are placed in one
+  XLA jit scope so that they are fused into a single elementwise kernel.
+  """
+  with tf.name_scope("gru_combine", [gate_pre, candidate_pre, inputs]), \
+      jit.experimental_jit_scope():
+    gate = saturating_sigmoid(gate_pre)
+    candidate = tf.tanh(candidate_pre)
+    return gate * inputs + (1 - gate) * candidate
+
+
 def conv2d_lstm(inputs,
                 n_output_channels,
                 is_training,
@@ -371,6 +488,8 @@ def conv2d_lstm(inputs,
                 filter_size=3,
                 padding="SAME",
                 dilation=1,
+                data_format='NHWC',
+                compute_dtype=None,
                 name='conv2d_gru',
                 outputs_collections=None,
                 **kwargs):
@@ -407,6 +526,11 @@ def conv2d_lstm(inputs,
           `GraphKeys.TRAINABLE_VARIABLES` (see tf.Variable).
       name: Optional name or scope for variable_scope/name_scope.
       use_bias: Whether to add bias or not
+      data_format: one of `"NHWC"` (default) or `"NCHW"`. `"NCHW"` is only supported
+          on GPU, where cuDNN runs it without layout transposes.
+      compute_dtype: optional float dtype, e.g. `tf.float16`, to run the convs and
+          the gate activations in. The layer norm is computed in float32 and the
+          output is cast back to the dtype of `inputs`.
 
   Returns:
       The 4-D `Tensor` variable representing the result of the series of operations.
@@ -416,6 +540,9 @@ def conv2d_lstm(inputs,
       ValueError: if x has rank less than 4 or if its last dimension is not set.
   """
   with tf.variable_scope(name, reuse=reuse):
+    dtype = inputs.dtype
+    if compute_dtype is not None:
+      inputs = tf.cast(inputs, compute_dtype)
     gates = conv2d_v2(
         inputs,
         4 * n_output_channels,
@@ -424,14 +551,64 @@ def conv2d_lstm(inputs,
         filter_size=filter_size,
         padding=padding,
         dilation=dilation,
+        data_format=data_format,
         name=name,
         **kwargs)
-    g = tf.split(layer_norm(gates, 4 * n_ouput_channels), 4, axis=3)
-    new_cell = tf.sigmoid(g[0]) * x + tf.sigmoid(g[1]) * tf.tanh(g[3])
-    outputs = tf.sigmoid(g[2]) * tf.tanh(new_cell)
+    channel_axis = 1 if data_format == 'NCHW' else 3
+    trainable = kwargs.get('trainable', True)
+    if gates.dtype.base_dtype in (tf.float16, tf.bfloat16):
+      # Reduced precision is not accurate enough for the moments.
+      gates = tf.cast(gates, tf.float32)
+    if data_format == 'NCHW':
+      gates = _layer_norm_channels_first(gates, reuse, trainable=trainable)
+    else:
+      gates = layer_norm(gates, reuse, trainable=trainable, allow_defun=True)
+    outputs = _lstm_combine(tf.cast(gates, inputs.dtype), inputs, channel_axis)
+    outputs = tf.cast(outputs, dtype)
     return _collect_named_outputs(outputs_collections, name, outputs)
 
 
+def _layer_norm_channels_first(x, reuse, trainable=True, epsilon=1e-6, name='layer_norm'):
+  """Layer normalize a channels first (NCHW) x over its channel axis.
+
+  Same variables and result as `layer_norm`, which only normalizes over the
+  last axis; the moments and the affine transform are placed in one XLA jit
+  scope so that x is streamed once.
+  """
+  filters = x.get_shape()[1]
+  with tf.variable_scope(name, reuse=reuse):
+    scale = tf.get_variable(
+        "layer_norm_scale", [filters], initializer=tf.ones_initializer(), trainable=trainable)
+    bias = tf.get_variable(
+        "layer_norm_bias", [filters], initializer=tf.zeros_initializer(), trainable=trainable)
+    if scale.dtype.base_dtype != x.dtype.base_dtype:
+      scale = tf.cast(scale, x.dtype)
+      bias = tf.cast(bias, x.dtype)
+    # Broadcast the per-channel parameters over the trailing spatial axes.
+    params_shape = [-1] + [1] * (len(x.get_shape()) - 2)
+    scale = tf.reshape(scale, params_shape)
+    bias = tf.reshape(bias, params_shape)
+    with jit.experimental_jit_scope():
+      mean, variance = tf.nn.moments(x, [1], keep_dims=True)
+      return (x - mean) * tf.rsqrt(variance + epsilon) * scale + bias
+
+
+def _lstm_combine(gates, inputs, channel_axis=3):
+  """LSTM state update from the normalized gate pre-activations.
+
+  The gate split, activations and products are placed in one XLA jit scope so
+  that they are fused into a single elementwise kernel reading the gates once.
+  """
+  with tf.name_scope("lstm_combine", [gates, inputs]), jit.experimental_jit_scope():
+    # Split the 4 gates by reshaping the channel axis to [4, C] and unstacking the
+    # new axis, which avoids a strided split kernel on the innermost axis.
+    shape = shape_list(gates)
+    gates_shape = shape[:channel_axis] + [4, -1] + shape[channel_axis + 1:]
+    g = tf.unstack(tf.reshape(gates, gates_shape), axis=channel_axis)
+    new_cell = tf.sigmoid(g[0]) * inputs + tf.sigmoid(g[1]) * tf.tanh(g[3])
+    return tf.sigmoid(g[2]) * tf.tanh(new_cell)
+
+
 def conv2d_diagonal_gru(inputs,
                         n_output_channels,
                         is_training,
@@ -4,7 +4,8 @@ from __future__ import print_function
 
 # Dependency imports
 import numpy as np
-from tefla.core.special_fn import fn_with_custom_grad, conv2d_gru, conv2d_lstm, multiscale_conv2d_sum, conv1d_memory_efficient, clip_variables
+from tefla.core.special_fn import fn_with_custom_grad, conv2d_gru, conv2d_lstm, multiscale_conv2d_sum, conv1d_memory_efficient, clip_variables, saturating_sigmoid, \
+    format_input_left_padding, conv2d_v2
 import tensorflow as tf
 
 
@@ -74,6 +75,42 @@ class FnWithCustomGradTest(tf.test.TestCase):
       for g1, g2 in zip(g_val, eg_val):
         self.assertAllClose(g1, g2)
 
+  def testIdentityFunctionIsShared(self):
+
+    def fn(a):
+      return tf.layers.dense(a, 10, use_bias=False)
+
+    def grad_fn(inputs, variables, unused_outputs, unused_grad_outputs):
+      return [tf.ones_like(t) for t in inputs], [tf.ones_like(t) for t in variables]
+
+    custom_fn = fn_with_custom_grad(grad_fn)(fn)
+    a = tf.random_uniform([11, 6])
+    out1 = custom_fn(a)
+    out2 = custom_fn(a)
+    functions = tf.get_default_graph().as_graph_def().library.function
+    self.assertEqual(len(functions), 1)
+    grads = tf.gradients(tf.reduce_mean(out1) + tf.reduce_mean(out2), [a])
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      self.assertAllClose(sess.run(grads[0]), 2 * np.ones([11, 6]))
+
+  def testSharedScope(self):
+
+    def fn(a):
+      w = tf.get_variable("w", [6, 10])
+      return tf.matmul(a, w)
+
+    def grad_fn(inputs, variables, unused_outputs, unused_grad_outputs):
+      return [tf.ones_like(t) for t in inputs], [tf.ones_like(t) for t in variables]
+
+    with tf.variable_scope("shared", reuse=tf.AUTO_REUSE) as vs:
+      pass
+    custom_fn = fn_with_custom_grad(grad_fn, scope=vs)(fn)
+    a = tf.random_uniform([11, 6])
+    custom_fn(a)
+    custom_fn(a)
+    self.assertEqual([v.name for v in tf.trainable_variables()], ["shared/w:0"])
+
   def testConvGRU(self):
     x = tf.convert_to_tensor(np.random.rand(5, 7, 3, 11), dtype=tf.float32)
     with self.test_session() as session:
@@ -85,10 +122,101 @@ class FnWithCustomGradTest(tf.test.TestCase):
     self.assertEqual(res1.shape, (5, 7, 3, 11))
     self.assertEqual(res2.shape, (5, 7, 3, 11))
 
+  def testLeftPaddingStaticShape(self):
+    x = tf.zeros([2, 7, 5, 3])
+    y, kwargs = format_input_left_padding(x, filter_size=(3, 3), dilation=2)
+    op_types = set(op.type for op in tf.get_default_graph().get_operations())
+    self.assertNotIn('Switch', op_types)
+    self.assertNotIn('Pack', op_types)
+    self.assertEqual(kwargs['padding'], 'VALID')
+    with self.test_session() as session:
+      res = session.run(y)
+    self.assertEqual(res.shape, (2, 11, 9, 3))
+
+  def testConvGRUHalfPrecision(self):
+    x = tf.convert_to_tensor(np.random.rand(5, 7, 3, 11), dtype=tf.float32)
+    with self.test_session() as session:
+      y = conv2d_gru(x, 11, False, None, filter_size=(1, 3), compute_dtype=tf.float16)
+      self.assertEqual(y.dtype, tf.float32)
+      self.assertTrue(all(v.dtype.base_dtype == tf.float32 for v in tf.global_variables()))
+      session.run(tf.global_variables_initializer())
+      res = session.run(y)
+    self.assertEqual(res.shape, (5, 7, 3, 11))
+
+  def testLeftPaddingDynamicWidth(self):
+    for data_format in ('NHWC', 'NCHW'):
+      nchw = data_format == 'NCHW'
+      x = tf.placeholder(tf.float32, [2, 3, 7, None] if nchw else [2, 7, None, 3])
+      y, _ = format_input_left_padding(x, filter_size=(3, 3), dilation=2, data_format=data_format)
+      with self.test_session() as session:
+        for width, padded_width in ((1, 1), (5, 9)):
+          shape = (2, 3, 7, width) if nchw else (2, 7, width, 3)
+          x_val = np.random.rand(*shape)
+          res = session.run(y, feed_dict={x: x_val})
+          if nchw:
+            self.assertEqual(res.shape, (2, 3, 11, padded_width))
+            self.assertAllClose(res[:, :, 4:, padded_width - width:], x_val)
+          else:
+            self.assertEqual(res.shape, (2, 11, padded_width, 3))
+            self.assertAllClose(res[:, 4:, padded_width - width:, :], x_val)
+    op_types = set(op.type for op in tf.get_default_graph().get_operations())
+    self.assertIn('Switch', op_types)
+
   def testConvLSTM(self):
     x = tf.convert_to_tensor(np.random.rand(5, 7, 11, 13), dtype=tf.float32)
     with self.test_session() as session:
-      y = conv2d_gru(x, 13, False, None, filter_size=(1, 3))
+      y = conv2d_lstm(x, 13, False, None, filter_size=(1, 3))
+      session.run(tf.global_variables_initializer())
+      res = session.run(y)
+    self.assertEqual(res.shape, (5, 7, 11, 13))
+
+  def testDilatedConvMatchesAtrousConv(self):
+    x = tf.convert_to_tensor(np.random.rand(2, 13, 11, 3), dtype=tf.float32)
+    outputs, expected = [], []
+    for dilation in (2, 4):
+      for padding in ('SAME', 'VALID'):
+        for untie_biases in (False, True):
+          name = 'conv_%d_%s_%d' % (dilation, padding, untie_biases)
+          outputs.append(
+              conv2d_v2(
+                  x,
+                  5,
+                  False,
+                  None,
+                  filter_size=3,
+                  dilation=dilation,
+                  padding=padding,
+                  b_init=0.5,
+                  untie_biases=untie_biases,
+                  name=name))
+          with tf.variable_scope(name, reuse=True):
+            w = tf.get_variable('W')
+            b = tf.get_variable('b')
+          conv = tf.nn.atrous_conv2d(x, w, dilation, padding)
+          expected.append(tf.add(conv, b) if untie_biases else tf.nn.bias_add(conv, b))
+    with self.test_session() as session:
+      session.run(tf.global_variables_initializer())
+      # Randomize the biases so that untied biases differ per position.
+      session.run([v.assign(tf.random_uniform(v.get_shape())) for v in tf.global_variables()])
+      outputs_val, expected_val = session.run([outputs, expected])
+    for out, exp in zip(outputs_val, expected_val):
+      self.assertEqual(out.shape, exp.shape)
+      self.assertAllClose(out, exp, rtol=1e-5, atol=1e-5)
+
+  def testSaturatingSigmoid(self):
+    x = np.array([-10.0, -1.0, 0.0, 1.0, 10.0], dtype=np.float32)
+    expected = np.clip(1.2 / (1.0 + np.exp(-x)) - 0.1, 0.0, 1.0)
+    with self.test_session() as session:
+      res = session.run(saturating_sigmoid(tf.convert_to_tensor(x)))
+    self.assertAllClose(res, expected)
+
+  def testConvLSTMDoublePrecision(self):
+    x = tf.convert_to_tensor(np.random.rand(5, 7, 11, 13), dtype=tf.float64)
+    with self.test_session() as session:
+      y = conv2d_lstm(x, 13, False, None, filter_size=(1, 3))
+      self.assertEqual(y.dtype, tf.float64)
+      casts = [op for op in tf.get_default_graph().get_operations() if op.type == 'Cast']
+      self.assertNotIn(tf.float32, [op.outputs[0].dtype for op in casts])
       session.run(tf.global_variables_initializer())
       res = session.run(y)
     self.assertEqual(res.shape, (5, 7, 11, 13))